@@ -1,23 +1,53 @@
+import io
 import os
+import re
 import json
-import uuid
+import time
+import secrets
+import atexit
+import shutil
+import tempfile
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from flask import Flask, render_template, request, jsonify, send_from_directory
+from functools import lru_cache
+from types import MappingProxyType
+from urllib.parse import quote as url_quote
+from flask import Flask, Response, render_template, request, jsonify, send_from_directory, abort
+from flask.json.provider import DefaultJSONProvider
+from werkzeug.security import safe_join
 from flask_cors import CORS
 from dotenv import load_dotenv
-from openai import OpenAI
+from openai import OpenAI, DefaultHttpxClient
+import requests
 from reportlab.lib.pagesizes import letter
 from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.lib.enums import TA_CENTER, TA_JUSTIFY
 from reportlab.lib import colors
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.ttfonts import TTFont
 import stripe
+import orjson
 
 # Load environment variables
 load_dotenv()
 
+class OrjsonProvider(DefaultJSONProvider):
+    """ Flask JSON provider backed by orjson, used by jsonify and request.json. """
+
+    def dumps(self, obj, **kwargs):
+        option = orjson.OPT_SORT_KEYS if kwargs.get("sort_keys", self.sort_keys) else 0
+        return orjson.dumps(obj, default=self.default, option=option).decode("utf-8")
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 # Initialize Flask app
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 app.secret_key = os.getenv("SECRET_KEY", "default-secret-key")
 
 # Configure CORS
@@ -27,62 +57,95 @@ CORS(app)
 stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
 STRIPE_PUBLISHABLE_KEY = os.getenv("STRIPE_PUBLISHABLE_KEY")
 
+# Share one requests session across all Stripe calls. Stripe's default client keeps a
+# session per thread, and under gevent every request runs in its own greenlet.
+stripe_session = requests.Session()
+stripe.default_http_client = stripe.RequestsClient(session=stripe_session)
+atexit.register(stripe_session.close)
+
 # Configure OpenAI API key
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-client = OpenAI(api_key=OPENAI_API_KEY)
+
+# One pooled HTTP/2 connection to the API is multiplexed by all concurrent requests.
+# A call and its one retry must give up before the job is declared lost (JOB_TIMEOUT).
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", 240))
+openai_http_client = DefaultHttpxClient(http2=True)
+atexit.register(openai_http_client.close)
+client = OpenAI(api_key=OPENAI_API_KEY, http_client=openai_http_client, timeout=OPENAI_TIMEOUT, max_retries=1)
+OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4-turbo")
+OPENAI_MAX_TOKENS = int(os.getenv("OPENAI_MAX_TOKENS", 4000))
 
 # Ensure the downloads directory exists
 DOWNLOAD_FOLDER = os.path.join(os.getcwd(), "static", "downloads")
 os.makedirs(DOWNLOAD_FOLDER, exist_ok=True)
-
-# Document types for real estate
-DOCUMENT_TYPES = {
+PDF_WRITE_BUFFER_SIZE = 1 << 20
+
+# Rendered PDFs are cached by content and hard-linked into place on repeat requests
+PDF_CACHE_FOLDER = os.path.join(DOWNLOAD_FOLDER, "_cache")
+os.makedirs(PDF_CACHE_FOLDER, exist_ok=True)
+PDF_CACHE_MAX_FILES = int(os.getenv("PDF_CACHE_MAX_FILES", 512))
+
+# Generation jobs run in the background; their status files are shared by all worker processes.
+# The folder lives outside static/ so Flask's static route never serves it.
+JOB_FOLDER = os.path.join(os.getcwd(), "jobs")
+os.makedirs(JOB_FOLDER, exist_ok=True)
+# Jobs still queued or started after this long were lost (e.g. to a worker restart)
+JOB_TIMEOUT = 600
+# Status files older than this are removed
+JOB_RETENTION = 24 * 3600
+# Under gevent the pool's threads are greenlets, so size it like the worker's connection limit;
+# a smaller pool would leave jobs queued long enough to time out
+generation_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("GENERATION_WORKERS", os.getenv("GUNICORN_WORKER_CONNECTIONS", 1000))))
+
+# Downloads are private to the customer but safe for their browser to reuse for an hour
+DOWNLOAD_MAX_AGE = 3600
+
+# When set (e.g. "/internal-downloads/"), downloads are delegated to nginx via X-Accel-Redirect
+DOWNLOAD_ACCEL_PREFIX = os.getenv("DOWNLOAD_ACCEL_PREFIX")
+
+# Register a Unicode-friendly font (DejaVuSans) once per process
+PDF_FONT_PATH = '/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf'
+if os.path.exists(PDF_FONT_PATH):
+    pdfmetrics.registerFont(TTFont('DejaVu', PDF_FONT_PATH))
+    PDF_FONT = 'DejaVu'
+else:
+    PDF_FONT = 'Helvetica'
+
+# PDF styles are constant, so build them once at import
+STYLES = getSampleStyleSheet()
+TITLE_STYLE = ParagraphStyle('Title', parent=STYLES['Heading1'], fontName=PDF_FONT,
+                             fontSize=16, alignment=TA_CENTER, textColor=colors.navy)
+NORMAL_STYLE = ParagraphStyle('Normal', parent=STYLES['Normal'], fontName=PDF_FONT,
+                              fontSize=11, alignment=TA_JUSTIFY, leading=14)
+WATERMARK_MARKUP = "<font color='red'>WATERMARKED PREVIEW</font>"
+
+# Document types for real estate, read-only so no request can alter them
+DEFAULT_DOCUMENT_TYPE_NAME = "Real Estate Document"
+DOCUMENT_TYPES = MappingProxyType({
     "sales_contract": "Real Estate Sales Contract",
     "lease_agreement": "Residential Lease Agreement",
     "addendum": "Real Estate Contract Addendum",
     "disclosure": "Property Condition Disclosure"
-}
+})
 
-@app.route('/')
-def index():
-    return render_template('index.html', document_types=DOCUMENT_TYPES, stripe_key=STRIPE_PUBLISHABLE_KEY)
+# PDF titles for each document type, upper-cased once at import
+TITLES = MappingProxyType({key: name.upper() for key, name in DOCUMENT_TYPES.items()})
+DEFAULT_TITLE = DEFAULT_DOCUMENT_TYPE_NAME.upper()
 
-@app.route('/generate-document', methods=['POST'])
-def generate_document():
-    """Generates a FAR/BAR-style real estate document with preview and final PDF versions."""
-    try:
-        # Handle both JSON and form data
-        if request.is_json:
-            form_data = request.json
-        else:
-            form_data = request.form
-
-        # Extract data
-        document_type = form_data.get('document_type', 'real_estate_document')
-        buyer_name = form_data.get('buyer_name', 'Buyer')
-        seller_name = form_data.get('seller_name', 'Seller')
-        client_name = form_data.get('client_name', 'Client')
-        property_address = form_data.get('property_address', 'Unknown Address')
-        purchase_price = form_data.get('purchase_price', '0')
-        closing_date = form_data.get('closing_date', 'TBD')
-        party_role = form_data.get('party_role', 'N/A')
-        property_state = form_data.get('property_state', 'Florida')
-        transaction_type = form_data.get('transaction_type', 'Residential Purchase')
-        additional_instructions = form_data.get('additional_instructions', '')
-
-        # Optional Clauses
-        clause_inspection = bool(form_data.get('clause_inspection'))
-        clause_financing = bool(form_data.get('clause_financing'))
-        clause_appraisal = bool(form_data.get('clause_appraisal'))
-        clause_hoa = bool(form_data.get('clause_hoa'))
-
-        # Unique file names
-        unique_id = uuid.uuid4().hex[:8]
-        preview_filename = f"preview_{document_type}_{unique_id}.pdf"
-        final_filename = f"{document_type}_{unique_id}.pdf"
-
-        # Refined OpenAI prompt
-        prompt = f"""
+def warm_pdf_renderer():
+    """ Renders a throwaway PDF so ReportLab's lazy font and layout setup happens at startup. """
+    SimpleDocTemplate(io.BytesIO(), pagesize=letter).build([
+        Paragraph("Warm-up", TITLE_STYLE),
+        Paragraph("<b>Warm-up</b> &amp; <font color='red'>warm-up</font>", NORMAL_STYLE)
+    ])
+
+warm_pdf_renderer()
+
+SYSTEM_PROMPT = "You are a real estate document assistant generating legally formatted contracts for Florida."
+
+# Contract instructions, filled in per request from the submitted form
+PROMPT_TEMPLATE = """
 Generate a professional Florida real estate contract styled after a FAR/BAR agreement. Use legal formatting, numbered sections, and clear, formal language expected in a standard real estate transaction.
 
 Include the following fields:
@@ -106,79 +169,343 @@ Include the following fields:
 Include all required legal disclosures and a signature section for both buyer and seller. Start with a title header, and mark the preview as 'WATERMARKED' if requested.
 """
 
-        # Request to OpenAI
-        response = client.chat.completions.create(
-            model="gpt-4-turbo",
-            messages=[
-                {"role": "system", "content": "You are a real estate document assistant generating legally formatted contracts for Florida."},
-                {"role": "user", "content": prompt}
-            ],
-            max_tokens=4000
-        )
+# Form fields substituted into PROMPT_TEMPLATE as (form name, default)
+PROMPT_FIELDS = (
+    ('document_type', 'real_estate_document'),
+    ('buyer_name', 'Buyer'),
+    ('seller_name', 'Seller'),
+    ('property_address', 'Unknown Address'),
+    ('purchase_price', '0'),
+    ('closing_date', 'TBD'),
+    ('party_role', 'N/A'),
+    ('property_state', 'Florida'),
+    ('transaction_type', 'Residential Purchase'),
+    ('additional_instructions', '')
+)
+
+# Optional clause checkboxes, substituted into PROMPT_TEMPLATE as True/False
+PROMPT_CLAUSES = ('clause_inspection', 'clause_financing', 'clause_appraisal', 'clause_hoa')
+
+class PromptCache:
+    """ Thread-safe LRU cache of OpenAI completions keyed by a hash of the normalized prompt. """
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(model, prompt):
+        # Whitespace differences never change the generated contract, so collapse them
+        normalized = re.sub(r"\s+", " ", prompt).strip()
+        return hashlib.blake2b(f"{model}\0{normalized}".encode("utf-8")).hexdigest()
+
+    def get_or_compute(self, model, prompt, compute):
+        """ Returns the cached value for a prompt, or calls compute(), which returns
+        (value, cacheable); only cacheable values are stored. """
+        key = self.key(model, prompt)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+
+        value, cacheable = compute()
+        if not cacheable:
+            return value
+
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return value
+
+prompt_cache = PromptCache(maxsize=int(os.getenv("PROMPT_CACHE_SIZE", 256)))
 
-        document_text = response.choices[0].message.content
+@app.route('/')
+def index():
+    return render_template('index.html', document_types=DOCUMENT_TYPES, stripe_key=STRIPE_PUBLISHABLE_KEY)
 
-        # Generate PDFs
-        preview_path = os.path.join(DOWNLOAD_FOLDER, preview_filename)
-        final_path = os.path.join(DOWNLOAD_FOLDER, final_filename)
+@app.route('/generate-document', methods=['POST'])
+def generate_document():
+    """Queues a FAR/BAR-style real estate document for generation and returns a URL to poll for its PDFs."""
+    try:
+        # Handle both JSON and form data
+        if request.is_json:
+            form_data = request.json
+        else:
+            form_data = request.form.to_dict()
 
-        create_pdf(document_text, preview_path, client_name, DOCUMENT_TYPES.get(document_type, "Real Estate Document"), watermark=True)
-        create_pdf(document_text, final_path, client_name, DOCUMENT_TYPES.get(document_type, "Real Estate Document"), watermark=False)
+        # The job id doubles as the unique part of the document's file names
+        job_id = secrets.token_urlsafe(9)
+        write_job_status(job_id, {'state': 'queued'})
+        generation_executor.submit(run_generation_job, job_id, form_data)
 
         return jsonify({
             'success': True,
-            'preview_url': f'/download/{preview_filename}',
-            'final_filename': final_filename
-        })
+            'job_id': job_id,
+            'status_url': f'/status/{job_id}'
+        }), 202
 
     except Exception as e:
-        app.logger.error(f"Error generating document: {str(e)}")
+        app.logger.error(f"Error queueing document: {str(e)}")
         return jsonify({'error': f'Failed to generate document: {str(e)}'}), 500
 
-from reportlab.pdfbase import pdfmetrics
-from reportlab.pdfbase.ttfonts import TTFont
-from reportlab.pdfbase.pdfmetrics import registerFont
+@app.route('/status/<job_id>')
+def job_status(job_id):
+    """ Reports the state of a document generation job, with its download links once finished. """
+    status = read_job_status(job_id)
+    if status is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    return jsonify(status)
+
+def run_generation_job(job_id, form_data):
+    """ Runs a queued generation job and records its outcome for /status. """
+    prune_job_statuses()
+    # A job that already timed out was reported as failed; don't run it behind the user's back
+    status = read_job_status(job_id)
+    if status is None or status['state'] in ('finished', 'failed'):
+        return
+    write_job_status(job_id, {'state': 'started'})
+    try:
+        result = generate_document_files(form_data, job_id)
+        write_job_status(job_id, {'state': 'finished', 'success': True, **result})
+    except Exception as e:
+        app.logger.error(f"Error generating document: {str(e)}")
+        write_job_status(job_id, {'state': 'failed', 'error': f'Failed to generate document: {str(e)}'})
 
-def create_pdf(text, filepath, client_name, document_type, watermark=False):
-    """ Generates a PDF document with an optional watermark. """
-    from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer
-    from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-    from reportlab.lib.enums import TA_CENTER, TA_JUSTIFY
-    from reportlab.lib import colors
+def job_status_path(job_id):
+    """ Returns the status file for a job id, or None if the id is not a safe file name. """
+    return safe_join(JOB_FOLDER, f"{job_id}.json")
 
-    # Register a Unicode-friendly font (DejaVuSans)
-    pdfmetrics.registerFont(TTFont('DejaVu', '/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf'))
+def write_job_status(job_id, status):
+    """ Atomically records a job's status where every worker process can read it. """
+    path = job_status_path(job_id)
+    fd, tmp_path = tempfile.mkstemp(dir=JOB_FOLDER, suffix=".tmp")
+    try:
+        with open(fd, 'w') as f:
+            json.dump(status, f)
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def read_job_status(job_id):
+    """ Loads a job's recorded status, or None if the job is unknown. """
+    path = job_status_path(job_id)
+    if path is None:
+        return None
+    try:
+        with open(path) as f:
+            status = json.load(f)
+        updated = os.path.getmtime(path)
+    except FileNotFoundError:
+        return None
+
+    # A job that has not progressed within JOB_TIMEOUT is not coming back
+    if status['state'] in ('queued', 'started') and time.time() - updated > JOB_TIMEOUT:
+        status = {'state': 'failed', 'error': 'Document generation timed out. Please try again.'}
+        write_job_status(job_id, status)
+    return status
+
+def prune_job_statuses():
+    """ Removes status files (and leftover temp files) older than JOB_RETENTION. """
+    cutoff = time.time() - JOB_RETENTION
+    with os.scandir(JOB_FOLDER) as it:
+        for entry in it:
+            try:
+                if entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+
+def generate_document_files(form_data, unique_id):
+    """Generates a FAR/BAR-style real estate document with preview and final PDF versions."""
+    # Extract data
+    document_type = form_data.get('document_type', 'real_estate_document')
+    client_name = form_data.get('client_name', 'Client')
 
-    doc = SimpleDocTemplate(filepath, pagesize=letter)
-    styles = getSampleStyleSheet()
+    # Unique file names
+    preview_filename = f"preview_{document_type}_{unique_id}.pdf"
+    final_filename = f"{document_type}_{unique_id}.pdf"
 
-    title_style = ParagraphStyle('Title', parent=styles['Heading1'], fontName='DejaVu',
-                                 fontSize=16, alignment=TA_CENTER, textColor=colors.navy)
-    normal_style = ParagraphStyle('Normal', parent=styles['Normal'], fontName='DejaVu',
-                                  fontSize=11, alignment=TA_JUSTIFY, leading=14)
+    # Fill in the contract instructions from the submitted form
+    fields = {name: form_data.get(name, default) for name, default in PROMPT_FIELDS}
+    fields.update((name, bool(form_data.get(name))) for name in PROMPT_CLAUSES)
+    prompt = PROMPT_TEMPLATE.format_map(fields)
 
-    content = [Paragraph(f"{document_type.upper()}", title_style), Spacer(1, 20)]
-    content.append(Paragraph(f"Prepared for: {client_name}", title_style))
+    # Request to OpenAI (identical submissions are served from the prompt cache)
+    def request_completion():
+        response = client.chat.completions.create(
+            model=OPENAI_MODEL,
+            messages=[
+                {"role": "system", "content": SYSTEM_PROMPT},
+                {"role": "user", "content": prompt}
+            ],
+            max_tokens=OPENAI_MAX_TOKENS
+        )
+        choice = response.choices[0]
+        # Refusals, filtered or truncated completions must not stick to this form in the cache
+        text = choice.message.content
+        return text, bool(text) and choice.finish_reason == "stop"
+
+    document_text = prompt_cache.get_or_compute(OPENAI_MODEL, prompt, request_completion)
+    if not document_text:
+        raise ValueError("The model returned no document text")
+
+    # Generate PDFs
+    preview_path = os.path.join(DOWNLOAD_FOLDER, preview_filename)
+    final_path = os.path.join(DOWNLOAD_FOLDER, final_filename)
+
+    # Both versions share the split document lines; only the watermark block differs.
+    # Renders are cached on disk, so the text is only split on a cache miss.
+    lines = None
+    for path, watermark in ((preview_path, True), (final_path, False)):
+        cache_path = pdf_cache_path(document_text, client_name, document_type, watermark)
+        # Another worker may evict the entry at any time; a vanished entry is a cache miss
+        if os.path.exists(cache_path) and link_cached_pdf(cache_path, path):
+            continue
+        if lines is None:
+            lines = pdf_lines(document_text)
+        render_pdf(cache_path, build_pdf_content(lines, client_name, document_type, watermark))
+        if not link_cached_pdf(cache_path, path):
+            render_pdf(path, build_pdf_content(lines, client_name, document_type, watermark))
+    evict_pdf_cache()
+
+    return {
+        'preview_url': f'/download/{preview_filename}',
+        'final_filename': final_filename
+    }
+
+def pdf_lines(text):
+    """ Splits document text into the stripped, non-blank lines that become body paragraphs. """
+    return [para for para in map(str.strip, text.split('\n')) if para]
+
+def build_pdf_content(lines, client_name, document_type, watermark=False):
+    """ Builds the flowables for one render, optionally including the watermark block. """
+    # Paragraphs keep layout state from the document they were laid out in, so every
+    # render gets its own; only the plain-text lines are shared between renders
+    content = [Paragraph(TITLES.get(document_type, DEFAULT_TITLE), TITLE_STYLE), Spacer(1, 20)]
+    content.append(Paragraph(f"Prepared for: {client_name}", TITLE_STYLE))
     content.append(Spacer(1, 20))
-    content.append(Paragraph(f"Date: {datetime.now().strftime('%B %d, %Y')}", normal_style))
+    content.append(Paragraph(f"Date: {datetime.now().strftime('%B %d, %Y')}", NORMAL_STYLE))
     content.append(Spacer(1, 20))
 
     if watermark:
-        content.append(Paragraph("<font color='red'>WATERMARKED PREVIEW</font>", title_style))
+        content.append(Paragraph(WATERMARK_MARKUP, TITLE_STYLE))
         content.append(Spacer(1, 20))
 
-    paragraphs = text.split('\n')
-    for para in paragraphs:
-        if para.strip():
-            content.append(Paragraph(para.strip(), normal_style))
-            content.append(Spacer(1, 6))
+    # Each line becomes a paragraph followed by a small spacer
+    content.extend(flowable
+                   for para in lines
+                   for flowable in (Paragraph(para, NORMAL_STYLE), Spacer(1, 6)))
+
+    return content
 
-    doc.build(content)
+def render_pdf(filepath, content):
+    """ Lays out flowables into a PDF file. """
+    # Write through a large buffer into a temporary file and move it into place,
+    # so a concurrent download never sees a partially written PDF. The temp name is unique,
+    # since concurrent renders of the same cache entry target the same final path.
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(filepath), suffix=".tmp")
+    try:
+        with open(fd, 'wb', buffering=PDF_WRITE_BUFFER_SIZE) as f:
+            # mkstemp creates the file owner-only; downloads must stay readable (e.g. by nginx)
+            os.fchmod(f.fileno(), 0o644)
+            SimpleDocTemplate(f, pagesize=letter).build(content)
+        os.replace(tmp_path, filepath)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def pdf_cache_path(text, client_name, document_type, watermark):
+    """ Returns the cache location for a render of the given inputs. """
+    # The header carries today's date, so a render is only reusable on the same day
+    today = datetime.now().strftime('%Y-%m-%d')
+    key = hashlib.blake2b(repr((text, client_name, document_type, watermark, today)).encode("utf-8"),
+                          digest_size=16).hexdigest()
+    return os.path.join(PDF_CACHE_FOLDER, f"{key}.pdf")
+
+def link_cached_pdf(cache_path, filepath):
+    """ Hard-links a cached render to its download path, copying if links are unsupported.
+        Returns False if the entry was evicted before it could be linked. """
+    try:
+        try:
+            os.link(cache_path, filepath)
+        except FileNotFoundError:
+            raise
+        except OSError:
+            shutil.copyfile(cache_path, filepath)
+    except FileNotFoundError:
+        return False
+
+    # Mark the entry as recently used for eviction
+    try:
+        os.utime(cache_path)
+    except FileNotFoundError:
+        pass
+    return True
+
+def evict_pdf_cache():
+    """ Removes the least recently used renders once the cache exceeds PDF_CACHE_MAX_FILES. """
+    with os.scandir(PDF_CACHE_FOLDER) as it:
+        entries = [entry for entry in it if entry.name.endswith(".pdf")]
+    if len(entries) <= PDF_CACHE_MAX_FILES:
+        return
+
+    # Entries can disappear while we look at them when several workers evict at once
+    renders = []
+    for entry in entries:
+        try:
+            renders.append((entry.stat().st_mtime, entry.path))
+        except FileNotFoundError:
+            pass
+
+    renders.sort()
+    for _, path in renders[:len(renders) - PDF_CACHE_MAX_FILES]:
+        # Download paths hard-linked to this entry keep their own reference to the file
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
 
 @app.route('/download/<filename>')
 def download_file(filename):
     """ Allows users to download files. """
-    return send_from_directory(DOWNLOAD_FOLDER, filename, as_attachment=True)
+    if DOWNLOAD_ACCEL_PREFIX:
+        # Hand the transfer to the fronting nginx, which serves the file with sendfile(2)
+        if safe_join(DOWNLOAD_FOLDER, filename) is None:
+            abort(404)
+        response = Response(mimetype="application/pdf")
+        response.headers["X-Accel-Redirect"] = f"{DOWNLOAD_ACCEL_PREFIX.rstrip('/')}/{url_quote(filename)}"
+        response.headers.set("Content-Disposition", "attachment", filename=filename)
+        return response
+
+    path = safe_join(DOWNLOAD_FOLDER, filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+
+    # Werkzeug passes the open file to the server's wsgi.file_wrapper, which gunicorn sends with sendfile(2).
+    # The content-hash ETag lets browsers revalidate a repeat download with a 304.
+    response = send_from_directory(DOWNLOAD_FOLDER, filename, as_attachment=True,
+                                   etag=file_etag(path), max_age=DOWNLOAD_MAX_AGE)
+    response.cache_control.public = False
+    response.cache_control.private = True
+    return response
+
+def file_etag(path):
+    """ Returns a content-hash ETag for a download, hashing each file once per process. """
+    stat = os.stat(path)
+    return content_etag(path, stat.st_ino, stat.st_size)
+
+@lru_cache(maxsize=1024)
+def content_etag(path, inode, size):
+    # Downloads are never rewritten in place (renders replace or link whole files), so the
+    # inode and size identify the content and the hash can be reused
+    with open(path, 'rb') as f:
+        return hashlib.blake2b(f.read(), digest_size=16).hexdigest()
 
 @app.route('/create-checkout-session', methods=['POST'])
 def create_checkout_session():